@@ -1,10 +1,13 @@
-# brainbuddy_app.py — local auth + freemium + Stripe (no query-param dependency)
+# brainbuddy_app.py — local auth + freemium + Stripe (client_reference_id, not session_id in the URL)
 import os
 import json
 import time
+import sqlite3
 import hashlib
-from datetime import datetime
-from textwrap import dedent
+import functools
+import contextlib
+import threading
+from collections import OrderedDict
 
 import requests
 import streamlit as st
@@ -17,10 +20,19 @@ except Exception:
     stripe = None
     STRIPE_AVAILABLE = False
 
+# Faster JSON parsing when orjson is installed; stdlib json otherwise
+try:
+    import orjson
+    json_loads = orjson.loads
+except Exception:
+    json_loads = json.loads
+
 APP_DIR = os.path.dirname(__file__)
 
-# ===== Freemium limits (local JSON) =====
-USAGE_PATH = os.path.join(APP_DIR, ".usage.json")
+# ===== Freemium limits (local SQLite) =====
+DB_PATH = os.path.join(APP_DIR, "bb.db")
+USAGE_PATH = os.path.join(APP_DIR, ".usage.json")  # legacy, imported into DB_PATH
+PRO_PATH = os.path.join(APP_DIR, ".pro.json")  # legacy, imported into DB_PATH
 FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "5"))
 
 # ===== Engines =====
@@ -30,6 +42,13 @@ OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # optional
+OLLAMA_ENGINE_ID = f"ollama:{OLLAMA_MODEL}"
+OPENAI_ENGINE_ID = f"openai:{OPENAI_MODEL}"
+
+# ===== Answer cache =====
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX = 512
+ANSWER_CACHE_PER_USER = 32  # one user can't evict everyone else's answers
 
 # ===== Stripe =====
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
@@ -45,93 +64,313 @@ st.caption("Free tier with daily limits. Upgrade unlocks unlimited answers + upc
 st.caption("Mode: Local auth (nickname) — dev/demo only")
 
 # ===== Helpers =====
+@functools.lru_cache(maxsize=1024)
+def _uhash(key: str) -> str:
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
 def uhash(name: str) -> str:
+    return _uhash(name.strip().lower())
+
+def legacy_uhash(name: str) -> str:
+    # Pre-BLAKE2b ids (truncated SHA-256); only used to migrate existing rows.
     return hashlib.sha256(name.strip().lower().encode("utf-8")).hexdigest()[:16]
 
 def load_json(path, default):
     if os.path.exists(path):
         try:
-            with open(path, "r") as f: return json.load(f)
+            with open(path, "rb") as f: return json_loads(f.read())
         except Exception:
             return default
     return default
 
-def save_json(path, obj):
-    with open(path, "w") as f: json.dump(obj, f, indent=2)
+# ===== Storage (SQLite, WAL) =====
+@st.cache_resource
+def get_db():
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS usage(uid TEXT, day TEXT, n INT, PRIMARY KEY(uid, day)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS pro(uid TEXT PRIMARY KEY, session TEXT, ts REAL) WITHOUT ROWID")
+    conn.execute("CREATE INDEX IF NOT EXISTS pro_session ON pro(session)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v) WITHOUT ROWID")
+    import_legacy_json(conn)
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    return threading.Lock()
+
+@contextlib.contextmanager
+def db():
+    # The connection is shared by every session thread; use it one at a time
+    # so a transaction never picks up another session's statements.
+    with get_db_lock():
+        yield get_db()
+
+@contextlib.contextmanager
+def transaction(conn):
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def legacy_mtime(conn, path):
+    """Return path's mtime if it changed since the last import, else None."""
+    try:
+        mt = os.stat(path).st_mtime
+    except OSError:
+        return None
+    row = conn.execute("SELECT v FROM meta WHERE k = ?", (os.path.basename(path),)).fetchone()
+    return None if row and row[0] == mt else mt
+
+def import_legacy_json(conn):
+    # One-way import of the old .usage.json / .pro.json stores; existing rows win.
+    # A file is only parsed again if its mtime differs from the last import.
+    with transaction(conn):
+        mt = legacy_mtime(conn, USAGE_PATH)
+        if mt is not None:
+            usage = load_json(USAGE_PATH, {})
+            conn.executemany(
+                "INSERT OR IGNORE INTO usage(uid, day, n) VALUES(?, ?, ?)",
+                [(uid, day, n) for uid, days in usage.items() for day, n in days.items()],
+            )
+            conn.execute("INSERT OR REPLACE INTO meta(k, v) VALUES(?, ?)", (os.path.basename(USAGE_PATH), mt))
+        mt = legacy_mtime(conn, PRO_PATH)
+        if mt is not None:
+            pro = load_json(PRO_PATH, {})
+            conn.executemany(
+                "INSERT OR IGNORE INTO pro(uid, session, ts) VALUES(?, ?, ?)",
+                [(uid, rec.get("session"), rec.get("ts")) for uid, rec in pro.items()],
+            )
+            conn.execute("INSERT OR REPLACE INTO meta(k, v) VALUES(?, ?)", (os.path.basename(PRO_PATH), mt))
+
+def migrate_uid(old: str, new: str):
+    with db() as conn, transaction(conn):
+        conn.execute("UPDATE OR IGNORE usage SET uid = ? WHERE uid = ?", (new, old))
+        conn.execute("UPDATE OR IGNORE pro SET uid = ? WHERE uid = ?", (new, old))
+
+def get_count(uid: str, day: str) -> int:
+    with db() as conn:
+        row = conn.execute("SELECT n FROM usage WHERE uid = ? AND day = ?", (uid, day)).fetchone()
+    return row[0] if row else 0
+
+def inc_count(uid: str, day: str):
+    with db() as conn:
+        conn.execute(
+            "INSERT INTO usage(uid, day, n) VALUES(?, ?, 1) "
+            "ON CONFLICT(uid, day) DO UPDATE SET n = n + 1",
+            (uid, day),
+        )
+
+def is_pro_user(uid: str) -> bool:
+    with db() as conn:
+        return conn.execute("SELECT 1 FROM pro WHERE uid = ?", (uid,)).fetchone() is not None
+
+def session_granted(session_id: str) -> bool:
+    with db() as conn:
+        return conn.execute("SELECT 1 FROM pro WHERE session = ?", (session_id,)).fetchone() is not None
+
+def grant_pro(uid: str, session_id):
+    # Grants are append-only: the first grant for a uid is kept as-is.
+    with db() as conn:
+        conn.execute(
+            "INSERT INTO pro(uid, session, ts) VALUES(?, ?, ?) ON CONFLICT(uid) DO NOTHING",
+            (uid, session_id, time.time()),
+        )
 
 # ===== Engines =====
+@functools.cache
+def _openai_module():
+    # Imported on first use so Ollama/template-only runs never load the SDK.
+    try:
+        from openai import OpenAI
+        return OpenAI
+    except Exception:
+        return None
+
+# Clients are cached per process so reruns reuse pooled keep-alive connections.
+@st.cache_resource
+def get_openai_client():
+    OpenAI = _openai_module()
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None)
+
+@st.cache_resource
+def get_http_session():
+    return requests.Session()
+
+_STEPS_STR = "\n".join([
+    "1) Restate the question in your own words.",
+    "2) Identify key terms and define them simply.",
+    "3) Connect terms (cause/effect, compare/contrast).",
+    "4) Give a short example or analogy.",
+    "5) Summarize in 2–3 sentences.",
+])
+_STUDY_STR = "\n".join([
+    "- Make 5 flashcards: term → definition.",
+    "- Write a 3-sentence summary from memory.",
+    "- Do a 2-minute ‘teach-back’ out loud.",
+])
+_TEMPLATE = (
+    "{intro}\n\n"
+    "**Main points to know:**\n- {bullets}\n\n"
+    "**How to solve / study this quickly:**\n{steps}\n\n"
+    "**Mini study plan (5–10 minutes):**\n{study}\n"
+)
+
 def local_template_answer(question: str, points: int, tone: str) -> str:
     if not question.strip():
         return "Type something first 🙂"
-    intro = f"Here’s a {tone} explanation of **{question.strip()}**:"
-    bullets = [f"{i}. Key idea {i}: explain plainly with a short example." for i in range(1, points + 1)]
-    steps = [
-        "1) Restate the question in your own words.",
-        "2) Identify key terms and define them simply.",
-        "3) Connect terms (cause/effect, compare/contrast).",
-        "4) Give a short example or analogy.",
-        "5) Summarize in 2–3 sentences.",
-    ]
-    study = [
-        "- Make 5 flashcards: term → definition.",
-        "- Write a 3-sentence summary from memory.",
-        "- Do a 2-minute ‘teach-back’ out loud.",
-    ]
-    return dedent(f"""
-    {intro}
-
-    **Main points to know:**
-    - """ + "\n    - ".join(bullets) + """
-
-    **How to solve / study this quickly:**
-    """ + "\n".join(steps) + """
-
-    **Mini study plan (5–10 minutes):**
-    """ + "\n".join(study) + """
-    """)
+    return _TEMPLATE.format(
+        intro=f"Here’s a {tone} explanation of **{question.strip()}**:",
+        bullets="\n- ".join(f"{i}. Key idea {i}: explain plainly with a short example." for i in range(1, points + 1)),
+        steps=_STEPS_STR,
+        study=_STUDY_STR,
+    )
+
+_SYS_PROMPT = {"role": "system", "content": "You are a friendly, accurate teen study tutor. Be concise and clear."}
+_USER_TMPL = "Tone: {tone}. Explain this topic step-by-step with examples:\n\n{q}"
+
+def build_messages(question: str, tone: str):
+    return [_SYS_PROMPT, {"role": "user", "content": _USER_TMPL.format(tone=tone, q=question)}]
 
 def answer_with_ollama(question: str, tone: str):
     try:
         url = f"{OLLAMA_URL}/api/chat"
         payload = {
             "model": OLLAMA_MODEL,
-            "messages": [
-                {"role": "system", "content": "You are a friendly, accurate teen study tutor. Be concise and clear."},
-                {"role": "user", "content": f"Tone: {tone}. Explain this topic step-by-step with examples:\n\n{question}"},
-            ],
-            "stream": False,
+            "messages": build_messages(question, tone),
+            "stream": True,
         }
-        r = requests.post(url, json=payload, timeout=120)
+        r = get_http_session().post(url, json=payload, timeout=120, stream=True)
+    except Exception as e:
+        return None, f"Ollama error: {e}"
+    try:
         r.raise_for_status()
-        data = r.json()
-        return data.get("message", {}).get("content", ""), None
     except Exception as e:
+        r.close()  # streamed responses hold their pooled connection until closed
         return None, f"Ollama error: {e}"
 
+    def chunks():
+        with r:
+            for line in r.iter_lines():
+                if line:
+                    data = json_loads(line)
+                    if "error" in data:
+                        raise RuntimeError(data["error"])
+                    yield data.get("message", {}).get("content", "")
+    return chunks(), None
+
 def answer_with_openai(question: str, tone: str):
     if not OPENAI_API_KEY:
         return None, "No OpenAI API key set."
+    if _openai_module() is None:
+        return None, "OpenAI error: 'openai' package not installed."
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_BASE_URL else OpenAI(api_key=OPENAI_API_KEY)
-        msg = [
-            {"role": "system", "content": "You are a friendly, accurate teen study tutor. Be concise and clear."},
-            {"role": "user", "content": f"Tone: {tone}. Explain this topic step-by-step with examples:\n\n{question}"},
-        ]
-        resp = client.chat.completions.create(model=OPENAI_MODEL, messages=msg, temperature=0.4)
-        return resp.choices[0].message.content, None
+        client = get_openai_client()
+        stream = client.chat.completions.create(model=OPENAI_MODEL, messages=build_messages(question, tone), temperature=0.4, stream=True)
     except Exception as e:
         return None, f"OpenAI error: {e}"
 
-def get_answer(question: str, points: int, tone: str) -> str:
+    def chunks():
+        with stream:
+            for c in stream:
+                if c.choices:
+                    yield c.choices[0].delta.content or ""
+    return chunks(), None
+
+# Content-addressed cache of LLM answers (the local template is never cached)
+@st.cache_resource
+def get_answer_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "owners": {}}
+
+def answer_key(question: str, tone: str, engine_id: str) -> str:
+    raw = "\x1f".join((question.strip().lower(), tone, engine_id))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _cache_drop(cache, key):
+    _, uid, _ = cache["entries"].pop(key)
+    owned = cache["owners"][uid]
+    del owned[key]
+    if not owned:
+        del cache["owners"][uid]
+
+def cache_get(key: str):
+    cache = get_answer_cache()
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] > ANSWER_CACHE_TTL:
+            _cache_drop(cache, key)
+            return None
+        cache["entries"].move_to_end(key)
+        return hit[2]
+
+def cache_put(key: str, uid: str, text: str):
+    cache = get_answer_cache()
+    with cache["lock"]:
+        if key in cache["entries"]:
+            _cache_drop(cache, key)
+        owned = cache["owners"].get(uid, {})
+        if len(owned) >= ANSWER_CACHE_PER_USER:
+            _cache_drop(cache, next(iter(owned)))
+        while len(cache["entries"]) >= ANSWER_CACHE_MAX:
+            _cache_drop(cache, next(iter(cache["entries"])))
+        cache["entries"][key] = (time.time(), uid, text)
+        cache["owners"].setdefault(uid, {})[key] = None
+
+def get_answer_stream(question: str, points: int, tone: str, uid: str):
+    """Yield the answer in chunks: each engine in turn (cached or live), then the local template."""
+    engines = [(OPENAI_ENGINE_ID, answer_with_openai)]
     if USE_OLLAMA:
-        content, err = answer_with_ollama(question, tone)
-        if content: return content
+        engines.insert(0, (OLLAMA_ENGINE_ID, answer_with_ollama))
+    for engine_id, engine in engines:
+        # Keyed per engine so a fallback answer never lands under another model's key.
+        key = answer_key(question, tone, engine_id)
+        cached = cache_get(key)
+        if cached:
+            yield cached
+            return
+        stream, err = engine(question, tone)
+        parts = []
+        if stream is not None:
+            try:
+                for piece in stream:
+                    if piece:
+                        parts.append(piece)
+                        yield piece
+            except Exception as e:
+                err = f"Answer interrupted: {e}"
         if err: st.info(err)
-    content, err = answer_with_openai(question, tone)
-    if content: return content
-    if err: st.info(err)
-    return local_template_answer(question, points, tone)
+        if parts:
+            # Partial answers are shown but never cached.
+            if not err:
+                cache_put(key, uid, "".join(parts))
+            return
+    yield local_template_answer(question, points, tone)
+
+def lookup_paid_session(uid: str, legacy_uid: str):
+    """Return the id of a recent completed/paid checkout session for uid, or None.
+
+    Checkouts started before the BLAKE2b switch carry legacy_uid as their
+    client_reference_id, so those still count for this user.
+    """
+    for s in stripe.checkout.Session.list(limit=10).data:
+        if s.get("client_reference_id") in (uid, legacy_uid) and (
+            s.get("payment_status") == "paid" or
+            s.get("status") in ("complete",) or
+            (s.get("mode") == "subscription" and s.get("subscription"))
+        ):
+            return s.get("id")
+    return None
+
+# Cached so reruns don't re-list sessions; cleared when a new checkout starts.
+@st.cache_data(ttl=600, show_spinner=False)
+def find_paid_session(uid: str, legacy_uid: str):
+    return lookup_paid_session(uid, legacy_uid)
 
 # ===== Local auth + usage tracking =====
 if "user" not in st.session_state:
@@ -141,23 +380,53 @@ if st.session_state.user is None:
     st.subheader("Sign in (nickname only, dev/demo mode)")
     username = st.text_input("Pick a nickname:", placeholder="e.g., mattj")
     if st.button("Sign in"):
-        if username.strip():
-            st.session_state.user = {"name": username.strip(), "id": uhash(username)}
-            st.success(f"Signed in as {username.strip()}")
+        name = username.strip()
+        if name:
+            uid = uhash(name)
+            migrate_uid(legacy_uhash(name), uid)
+            st.session_state.user = {"name": name, "id": uid}
+            st.success(f"Signed in as {name}")
             st.rerun()
     st.stop()
 
 USER = st.session_state.user
-db = load_json(USAGE_PATH, {})
-today = datetime.now().strftime("%Y-%m-%d")
-used_today = db.get(USER["id"], {}).get(today, 0)
-remaining = max(0, FREE_DAILY_LIMIT - used_today)
+UID = USER["id"]
+is_pro = is_pro_user(UID)
+
+# Check Stripe until one lookup succeeds in this browser session, and on every
+# rerun while Checkout's ?status=success redirect is in the URL; that path skips
+# the cache so an earlier "not paid yet" can't hide the payment
+# (query_params values are plain strings)
+returned = st.query_params.get("status") == "success"
+if (not is_pro) and STRIPE_AVAILABLE and STRIPE_SECRET_KEY and (
+    returned or not st.session_state.get("stripe_checked")
+):
+    try:
+        lookup = lookup_paid_session if returned else find_paid_session
+        found = lookup(UID, legacy_uhash(USER["name"]))
+        st.session_state.stripe_checked = True
+        if found and not session_granted(found):
+            grant_pro(UID, found)
+            is_pro = True
+            st.query_params.clear()
+            st.success("✅ Premium unlocked!")
+    except Exception as e:
+        st.info(f"Stripe check error: {e}")
+
+# Pro users skip free-tier accounting entirely
+if not is_pro:
+    today = time.strftime("%Y-%m-%d")
+    used_today = get_count(UID, today)
+    remaining = max(0, FREE_DAILY_LIMIT - used_today)
 
 # Sidebar
 st.sidebar.subheader("Account")
 st.sidebar.write(f"User: **{USER['name']}**")
-st.sidebar.metric("Free answers left today", remaining)
-st.sidebar.caption(f"Daily reset at midnight • Limit: {FREE_DAILY_LIMIT}")
+if is_pro:
+    st.sidebar.success("Premium — unlimited answers")
+else:
+    st.sidebar.metric("Free answers left today", remaining)
+    st.sidebar.caption(f"Daily reset at midnight • Limit: {FREE_DAILY_LIMIT}")
 
 # Ask UI
 st.markdown("**Ask your homework question.** Free plan has daily limits.")
@@ -168,24 +437,19 @@ with col1:
 with col2:
     tone = st.selectbox("Tone", ["simple", "normal", "exam-ready"])
 
-if remaining <= 0:
+if not is_pro and remaining <= 0:
     st.warning("You’ve reached your free limit for today. Come back tomorrow or upgrade to Premium.")
 else:
     if st.button("Explain"):
         if not q.strip():
             st.warning("Type a question first.")
         else:
-            db.setdefault(USER["id"], {})
-            db[USER["id"]][today] = used_today + 1
-            save_json(USAGE_PATH, db)
-            st.caption(f"Free answers left after this: {max(0, remaining-1)}")
-            st.markdown(get_answer(q, max_points, tone))
-
-# ===== Premium (Stripe) — NO query param parsing =====
-PRO_PATH = os.path.join(APP_DIR, ".pro.json")
-pro_db = load_json(PRO_PATH, {})
-is_pro = USER["id"] in pro_db
+            if not is_pro:
+                inc_count(UID, today)
+                st.caption(f"Free answers left after this: {max(0, remaining-1)}")
+            st.write_stream(get_answer_stream(q, max_points, tone, UID))
 
+# ===== Premium (Stripe) — user matched by client_reference_id =====
 st.markdown("---")
 st.subheader("Upgrade to Premium")
 
@@ -197,10 +461,11 @@ else:
     else:
         # Create checkout session tagged to the current local user
         if st.button("Upgrade — $5/month via Stripe"):
+            find_paid_session.clear()
             try:
                 session = stripe.checkout.Session.create(
                     mode="subscription",
-                    client_reference_id=USER["id"],  # <— key change
+                    client_reference_id=UID,  # <— key change
                     line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
                     success_url=f"{PUBLIC_BASE_URL}?status=success",
                     cancel_url=f"{PUBLIC_BASE_URL}?status=cancel",
@@ -210,30 +475,3 @@ else:
                 st.stop()
             except Exception as e:
                 st.error(f"Stripe error: {e}")
-
-# When the page loads (or reloads), check Stripe for a recent completed session
-if (not is_pro) and STRIPE_AVAILABLE and STRIPE_SECRET_KEY:
-    try:
-        sessions = stripe.checkout.Session.list(limit=10)
-        # Find a recent session for this user with a completed/paid subscription
-        found = None
-        for s in sessions.data:
-            if s.get("client_reference_id") == USER["id"] and (
-                s.get("payment_status") == "paid" or
-                s.get("status") in ("complete",) or
-                (s.get("mode") == "subscription" and s.get("subscription"))
-            ):
-                found = s
-                break
-        if found:
-            pro_db[USER["id"]] = {"ts": time.time(), "session": found.get("id")}
-            save_json(PRO_PATH, pro_db)
-            is_pro = True
-            st.success("✅ Premium unlocked!")
-    except Exception as e:
-        st.info(f"Stripe check error: {e}")
-
-# If pro, lift limits (applies on next interaction)
-if is_pro:
-    FREE_DAILY_LIMIT = 10**9
-    remaining = 999999